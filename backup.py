@@ -38,16 +38,31 @@
 # SOFTWARE.
 
 import argparse
+import ctypes
+import ctypes.util
+import os
 import shutil
 import sqlite3
 import subprocess
 import sys
+import time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+from functools import lru_cache
+from itertools import groupby
+from operator import attrgetter, itemgetter
 from pathlib import Path
 
+# APFS can clone a file without copying its data, other platforms fall back to shutil
+clonefile = getattr(ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True), "clonefile", None)
+
 class Attachment:
+  HOME = str(Path.home())
+
+  __slots__ = ("id", "shortname", "filename")
+
   def __init__(self, id, shortname, filename):
     self.id = id
     self.shortname = shortname
@@ -63,7 +78,10 @@ class Attachment:
     return "%s-%s" % (self.id, self.shortname)
 
   def src_name(self):
-    return Path(self.filename).expanduser()
+    # Messages stores paths as ~/Library/..., so swap in the home directory without building a Path
+    if self.filename.startswith("~/"):
+      return self.HOME + self.filename[1:]
+    return self.filename
 
 class Chat:
   ALL = """SELECT chat.ROWID, handle.ROWID, handle.id
@@ -72,6 +90,8 @@ class Chat:
            INNER JOIN handle ON handle.ROWID = chat_handle_join.handle_id
            ORDER BY chat.ROWID, handle.id"""
 
+  __slots__ = ("id", "participants")
+
   @classmethod
   def all(cls, cursor):
     chats = defaultdict(dict)
@@ -104,14 +124,26 @@ class Message:
                 FROM message
                 ORDER BY date
                 LIMIT 1"""
-  FOR_DAY = """SELECT message.ROWID, message.date, chat_message_join.chat_id, handle.id, message.destination_caller_id, message.is_from_me, message.text, attachment.ROWID, attachment.transfer_name, attachment.filename
+  FOR_RANGE = """SELECT message.ROWID, message.date, chat_message_join.chat_id, handle.id, message.destination_caller_id, message.is_from_me, message.text
                FROM message
                INNER JOIN chat_message_join ON chat_message_join.message_id = message.ROWID
                LEFT JOIN handle on handle.ROWID = message.handle_id
-               LEFT JOIN message_attachment_join ON message_attachment_join.message_id = message.ROWID
-               LEFT JOIN attachment ON attachment.ROWID = message_attachment_join.attachment_id AND attachment.transfer_state = 5 AND attachment.hide_attachment != 1
                WHERE message.date BETWEEN :start AND :finish AND message.text IS NOT NULL
-               ORDER BY message.date"""
+               ORDER BY message.date, message.ROWID"""
+  ATTACHMENTS_FOR_RANGE = """SELECT message.date, message.ROWID, attachment.ROWID, attachment.transfer_name, attachment.filename
+                             FROM message
+                             INNER JOIN message_attachment_join ON message_attachment_join.message_id = message.ROWID
+                             INNER JOIN attachment ON attachment.ROWID = message_attachment_join.attachment_id
+                             WHERE message.date BETWEEN :start AND :finish AND message.text IS NOT NULL AND attachment.transfer_state = 5 AND attachment.hide_attachment != 1
+                             ORDER BY message.date, message.ROWID, message_attachment_join.ROWID"""
+  MAX_SENDER_LENGTHS = """SELECT chat_message_join.chat_id, date(message.date / 1000000000 + 978307200, 'unixepoch', 'localtime'), MAX(LENGTH(CASE WHEN message.is_from_me = 1 THEN message.destination_caller_id ELSE handle.id END))
+                          FROM message
+                          INNER JOIN chat_message_join ON chat_message_join.message_id = message.ROWID
+                          LEFT JOIN handle on handle.ROWID = message.handle_id
+                          WHERE message.date BETWEEN :start AND :finish AND message.text IS NOT NULL
+                          GROUP BY 1, 2"""
+
+  __slots__ = ("timestamp", "chat_id", "handle_id", "caller_id", "is_from_me", "text", "attachments")
 
   @classmethod
   def earliest_date(cls, cursor):
@@ -119,39 +151,73 @@ class Message:
     return cls._convert_from_timestamp(cursor.fetchone()[0]).date()
 
   @classmethod
-  def for_day(cls, cursor, date):
-    params = {}
-    params["start"] = cls._convert_to_timestamp(datetime.combine(date, datetime.min.time()))
-    params["finish"] = cls._convert_to_timestamp(datetime.combine(date, datetime.max.time()))
+  def for_range(cls, cursor, start, finish):
+    params = cls._range_params(start, finish)
+
+    # attachments are fetched separately so messages with several of them don't come back once per attachment,
+    # both queries are in (date, ROWID) order so they are walked side by side
+    attachment_cursor = cursor.connection.cursor()
+    attachment_cursor.arraysize = 2000
+    attachment_cursor.execute(cls.ATTACHMENTS_FOR_RANGE, params)
+    pending = groupby(cls._fetch(attachment_cursor), key=itemgetter(0, 1))
+    key, rows = next(pending, (None, None))
+
+    cursor.arraysize = 2000
+    cursor.execute(cls.FOR_RANGE, params)
+    message_id = None
+    for row in cls._fetch(cursor):
+      # a message in several chats comes back once per chat, each with the same attachments
+      if row[0] != message_id:
+        message_id = row[0]
+        attachments = []
+
+        # skip attachments for messages that aren't in any chat
+        while key is not None and key < (row[1], row[0]):
+          key, rows = next(pending, (None, None))
+
+        if key == (row[1], row[0]):
+          attachments = [Attachment(r[2], r[3], r[4]) for r in rows]
+          key, rows = next(pending, (None, None))
+
+      yield cls._load(row, attachments)
 
-    raw_messages = defaultdict(list)
-    for row in cursor.execute(cls.FOR_DAY, params):
-      raw_messages[row[0]].append(row)
+  @classmethod
+  def max_sender_lengths(cls, cursor, start, finish):
+    params = cls._range_params(start, finish)
 
-    return [Message._load(raw_messages[i]) for i in raw_messages]
+    return { (row[0], date.fromisoformat(row[1])): row[2] for row in cursor.execute(cls.MAX_SENDER_LENGTHS, params) }
+
+  @classmethod
+  def _range_params(cls, start, finish):
+    params = {}
+    params["start"] = cls._convert_to_timestamp(start)
+    params["finish"] = cls._convert_to_timestamp(finish + timedelta(days=1)) - 1
+    return params
+
+  @staticmethod
+  def _fetch(cursor):
+    while rows := cursor.fetchmany():
+      yield from rows
 
   @staticmethod
   def _convert_from_timestamp(value):
-    return datetime.fromtimestamp(value / 1000000000 + 978307200)
+    # whole seconds first so the day always matches the truncating division in the SQL queries
+    return datetime.fromtimestamp(value // 1000000000 + 978307200).replace(microsecond=value // 1000 % 1000000)
 
   @staticmethod
-  def _convert_to_timestamp(datetime):
-    return int((datetime.timestamp() - 978307200) * 1000000000)
+  def _convert_to_timestamp(day):
+    # local midnight of the day in whole seconds, then nanoseconds since 2001-01-01
+    return (int(time.mktime(day.timetuple())) - 978307200) * 1000000000
 
 
   @classmethod
-  def _load(cls, raw):
-    timestamp = cls._convert_from_timestamp(raw[0][1])
-    chat_id = raw[0][2]
-    handle_id = raw[0][3]
-    caller_id = raw[0][4]
-    is_from_me = raw[0][5] == 1
-    text = raw[0][6]
-    attachments = []
-
-    for row in raw:
-      if row[7] is not None:
-        attachments.append(Attachment(row[7], row[8], row[9]))
+  def _load(cls, row, attachments):
+    timestamp = cls._convert_from_timestamp(row[1])
+    chat_id = row[2]
+    handle_id = row[3]
+    caller_id = row[4]
+    is_from_me = row[5] == 1
+    text = row[6]
 
     return cls(timestamp, chat_id, handle_id, caller_id, is_from_me, text, attachments)
 
@@ -168,18 +234,26 @@ class Message:
     return "Message(timestamp=%r, chat_id=%r, handle_id=%r, caller_id=%r, is_from_me=%r, text=%r, attachments=%r)" % (self.timestamp, self.chat_id, self.handle_id, self.caller_id, self.is_from_me, self.text, self.attachments)
 
   def render(self, format, max_sender_length):
-    attachments = " ".join(map(str, self.attachments))
-    text = "\n".ljust(max_sender_length + 23).join(self.text.splitlines())
+    text = self.text
+
+    # printable text has no line breaks to indent, which is most messages
+    if not text.isprintable():
+      text = ("\n" + " " * (max_sender_length + 22)).join(text.splitlines())
 
     if self.attachments:
       text = text.replace(u"\ufffc", "")
+      attachments = " ".join(map(str, self.attachments))
+      text = f"{text} {attachments}" if text else attachments
 
-      if text:
-        text = " ".join([text, attachments])
-      else:
-        text = attachments
+    # bursts of messages share a second so only format each second once, unless the format shows microseconds
+    timestamp = self.timestamp if "%f" in format else self.timestamp.replace(microsecond=0)
 
-    return "%s %s: %s" % (self.timestamp.strftime(format), self.sender().rjust(max_sender_length), text)
+    return f"{self._strftime(timestamp, format)} {self.sender().rjust(max_sender_length)}: {text}"
+
+  @staticmethod
+  @lru_cache(maxsize=1024)
+  def _strftime(timestamp, format):
+    return timestamp.strftime(format)
 
   def sender(self):
     if self.is_from_me:
@@ -187,12 +261,70 @@ class Message:
     else:
       return self.handle_id
 
+class FastImport:
+  def __init__(self, dir):
+    self.dir = dir
+    status, ref = git(dir, "symbolic-ref", "--quiet", "HEAD")
+    if status != 0:
+      fatal(f"archive '{dir}' is not on a branch")
+    self.ref = ref.rstrip()
+    status, head = git(dir, "rev-parse", "--verify", "--quiet", "HEAD")
+    self.parent = head.rstrip() if status == 0 else None
+    status, ident = git(dir, "var", "GIT_COMMITTER_IDENT")
+    if status != 0:
+      fatal(ident.rstrip())
+    self.committer = ident.rsplit(" ", 2)[0]
+    self.committed = False
+    self.proc = subprocess.Popen(["git", "fast-import", "--quiet", "--date-format=now"], cwd=dir, stdin=subprocess.PIPE)
+
+    # without a closing done fast-import treats the stream as aborted and leaves the branch alone
+    self.proc.stdin.write(b"feature done\n")
+
+  def commit(self, message):
+    message = message.encode()
+    self.proc.stdin.write(b"commit %s\ncommitter %s now\ndata %d\n%s\n" % (self.ref.encode(), self.committer.encode(), len(message), message))
+    self.committed = True
+
+    # fast-import only chains commits made in this session, so the first one needs the existing tip
+    if self.parent:
+      self.proc.stdin.write(b"from %s\n" % self.parent.encode())
+      self.parent = None
+
+  def modify(self, path, data):
+    self.proc.stdin.write(b"M 100644 inline %s\ndata %d\n" % (bytes(path), len(data)))
+    self.proc.stdin.write(data)
+    self.proc.stdin.write(b"\n")
+
+  def modify_from(self, path, src):
+    with open(src, "rb") as f:
+      self.proc.stdin.write(b"M 100644 inline %s\ndata %d\n" % (bytes(path), os.fstat(f.fileno()).st_size))
+      shutil.copyfileobj(f, self.proc.stdin)
+    self.proc.stdin.write(b"\n")
+
+  def close(self):
+    self.proc.stdin.write(b"done\n")
+    self.proc.stdin.close()
+    if self.proc.wait() != 0:
+      fatal("git fast-import failed")
+
+    # the files are already in the working tree, only the index needs to catch up to the new commits
+    git(self.dir, "reset", "--quiet")
+
 def fatal(message):
   print(message, file=sys.stderr)
   exit(1)
 
-def git(dir, *args):
-  proc = subprocess.run(["git"] + list(args), cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+def copy_file(src, dst):
+  if clonefile:
+    # clonefile refuses to overwrite so clear out anything from a previous run
+    dst.unlink(missing_ok=True)
+    if clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+      return
+
+  shutil.copyfile(src, dst)
+
+def git(dir, *args, input=None):
+  proc = subprocess.run(["git"] + list(args), cwd=dir, input=input, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
   output = proc.stdout.decode(sys.getdefaultencoding())
   return (proc.returncode, output)
 
@@ -221,9 +353,16 @@ if not db.exists():
 if not path.exists():
   path.mkdir(parents=True)
 
-db = sqlite3.connect(f"file:{db}", uri=True)
+db = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
 cursor = db.cursor()
 
+# chat.db is only ever read and Messages keeps recent rows in its WAL, so only tune caching and leave journaling alone
+for pragma in ("PRAGMA temp_store = MEMORY", "PRAGMA cache_size = -262144", "PRAGMA mmap_size = 1073741824"):
+  cursor.execute(pragma)
+
+# Messages keeps writing while we run, so read everything from one snapshot
+cursor.execute("BEGIN")
+
 if use_git and not (path / ".git").exists():
   git(path, "init")
 
@@ -235,45 +374,74 @@ else:
 
 chats = { c.id: c for c in Chat.all(cursor) }
 
-for d in range(int((date.today() - lastrun_at).days)):
-  day = lastrun_at + timedelta(days=d)
+if use_git:
+  importer = FastImport(path)
+
+# read once so a run that crosses midnight doesn't record a day it never archived
+today = date.today()
+yesterday = today - timedelta(days=1)
+max_sender_lengths = Message.max_sender_lengths(cursor, lastrun_at, yesterday)
+created_dirs = set()
+
+# attachment copies are I/O bound, capped to keep the number of open files sane
+copier = ThreadPoolExecutor(max_workers=8)
+
+for day, messages_for_day in groupby(Message.for_range(cursor, lastrun_at, yesterday), key=lambda message: message.timestamp.date()):
   day_str = day.strftime(day_fmt)
 
-  messages_by_chat = defaultdict(list)
-  for message in Message.for_day(cursor, day):
-    messages_by_chat[message.chat_id].append(message)
+  if use_git:
+    importer.commit(f"Chat Archive for {day_str}")
 
-  for chat_id in messages_by_chat:
+  copies = []
+
+  # sorted is stable so each chat's messages stay in date order
+  for chat_id, messages in groupby(sorted(messages_for_day, key=attrgetter("chat_id")), key=attrgetter("chat_id")):
     chat_path = path / chats[chat_id].dir_name()
-    messages = messages_by_chat[chat_id]
-    max_sender_length = max(len(m.sender()) for m in messages)
+    messages = list(messages)
+    max_sender_length = max_sender_lengths[(chat_id, day)]
     messages_path = chat_path  / f"{day_str}.txt"
 
-    if not chat_path.exists():
-      chat_path.mkdir()
+    if chat_id not in created_dirs:
+      chat_path.mkdir(exist_ok=True)
+      created_dirs.add(chat_id)
+
+    lines = [message.render(fmt, max_sender_length) for message in messages]
+    content = ("\n".join(lines) + "\n").encode()
+    messages_path.write_bytes(content)
+
+    if use_git:
+      importer.modify(messages_path.relative_to(path), content)
 
-    with open(messages_path, "w") as f:
+    if attachments:
       for message in messages:
-        f.write("%s\n" % message.render(fmt, max_sender_length))
+        for attachment in message.attachments:
+          attachment_path = chat_path / attachment.dst_name()
 
-        if attachments:
-          for attachment in message.attachments:
-            attachment_path = chat_path / attachment.dst_name()
+          copies.append((attachment.src_name(), attachment_path))
 
-            shutil.copyfile(attachment.src_name(), attachment_path)
+          if use_git:
+            importer.modify_from(attachment_path.relative_to(path), attachment.src_name())
 
-            if use_git:
-              git(path, "add", attachment_path.relative_to(path))
+  list(copier.map(lambda copy: copy_file(*copy), copies))
 
-    if use_git:
-      git(path, "add", messages_path.relative_to(path))
+copier.shutdown()
+cursor.execute("COMMIT")
 
-  with open(lastrun, mode="w") as f:
-    f.write("%s\n" % (day + timedelta(days=1)).isoformat())
+if lastrun_at < today:
+  lastrun_content = ("%s\n" % today.isoformat()).encode()
+  lastrun.write_bytes(lastrun_content)
 
   if use_git:
-    git(path, "add", "lastrun")
-    git(path, "commit", "--allow-empty", "--message", f"Chat Archive for {day_str}")
+    # a fast-import commit stays open until the next command so lastrun lands in the last day's commit
+    if not importer.committed:
+      importer.commit(f"Chat Archive for {yesterday.strftime(day_fmt)}")
+
+    importer.modify(lastrun.relative_to(path), lastrun_content)
+
+if use_git:
+  importer.close()
 
-if use_git and git(path, "remote"):
+# reading the config saves spawning git just to list the remotes
+git_config = path / ".git" / "config"
+if use_git and git_config.exists() and "[remote " in git_config.read_text():
   git(path, "push")